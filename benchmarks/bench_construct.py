@@ -0,0 +1,44 @@
+"""Benchmark the time it takes to construct an SSHTunnelForwarderThread
+Compares constructing tunnels with the ssh binary discovery cache cleared
+before every tunnel (the behaviour before it was cached) to constructing
+them with a warm cache.
+
+    python benchmarks/bench_construct.py [iterations]
+"""
+from __future__ import print_function
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bgtunnel  # noqa: E402
+
+
+def construct():
+    bgtunnel.SSHTunnelForwarderThread(ssh_address='localhost',
+                                      host_port=5432, bind_port=15432)
+
+
+def construct_uncached():
+    bgtunnel.clear_ssh_path_cache()
+    construct()
+
+
+def run(iterations=100):
+    """Get the ms per tunnel, uncached and cached"""
+    return dict(
+        (label, timeit.timeit(func, number=iterations) / iterations * 1000)
+        for label, func in (('uncached', construct_uncached),
+                            ('cached', construct)))
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    results = run(iterations)
+    for label in ('uncached', 'cached'):
+        print(u'{:>8}: {:8.3f} ms per tunnel'.format(label, results[label]))
+
+
+if __name__ == '__main__':
+    main()
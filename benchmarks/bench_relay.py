@@ -0,0 +1,114 @@
+"""Benchmark the throughput of the relay used by instrumented tunnels
+Pushes a payload through an `SSHRelay` in front of a local sink server with
+each relay engine, and directly to the sink as a baseline. CPU time is for
+the whole process, so the difference to the baseline is the relay's cost.
+
+    python benchmarks/bench_relay.py [gigabytes]
+
+With `--ssh-address=user@host` the payload is also pushed through a real
+`ssh -L` forward to the sink, with and without `instrument=True`. The sink
+must then be reachable from the ssh server on 127.0.0.1.
+"""
+from __future__ import print_function
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bgtunnel  # noqa: E402
+
+CHUNK = b'x' * (1024 * 1024)
+
+
+def start_sink():
+    """Listen on a free port, reading every connection until EOF"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(8)
+
+    def drain(conn):
+        while conn.recv(1024 * 1024):
+            pass
+        conn.sendall(b'done')
+        conn.close()
+
+    def serve():
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=drain, args=(conn,)).start()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return server.getsockname()[1]
+
+
+def push(port, size):
+    sock = socket.create_connection(('127.0.0.1', port))
+    cpu_before = sum(os.times()[:2])
+    started = time.time()
+    for _ in range(size // len(CHUNK)):
+        sock.sendall(CHUNK)
+    sock.shutdown(socket.SHUT_WR)
+    sock.recv(4)
+    elapsed = time.time() - started
+    cpu = sum(os.times()[:2]) - cpu_before
+    sock.close()
+    return elapsed, cpu
+
+
+def relay_port(sink_port, engine):
+    bind_port = bgtunnel.port_allocator.allocate()
+    relay = bgtunnel.SSHRelay(
+        bgtunnel.AddressPortString(address='127.0.0.1', port=bind_port),
+        [bgtunnel.AddressPortString(address='127.0.0.1', port=sink_port)])
+    relay.engine = engine
+    relay.start()
+    return relay, bind_port
+
+
+def run(size, ssh_address=None):
+    """Get the MB/s and CPU seconds of pushing `size` bytes, by path"""
+    results = {}
+
+    def measure(label, port):
+        elapsed, cpu = push(port, size)
+        results[label] = {'mb_per_s': size / elapsed / 1e6, 'cpu_s': cpu}
+
+    sink_port = start_sink()
+    measure('direct', sink_port)
+    engines = ['copy']
+    if hasattr(os, 'splice'):
+        engines.append('splice')
+    for engine in engines:
+        relay, port = relay_port(sink_port, engine)
+        measure('relay ({})'.format(engine), port)
+        relay.stop()
+    if ssh_address:
+        for instrument in (False, True):
+            tunnel = bgtunnel.open(ssh_address, host_port=sink_port,
+                                   instrument=instrument, silent=True)
+            label = 'ssh -L (instrumented)' if instrument else 'ssh -L'
+            measure(label, tunnel.bind_port)
+            tunnel.close()
+    return results
+
+
+def main():
+    size = int(2e9)
+    ssh_address = None
+    for arg in sys.argv[1:]:
+        if arg.startswith('--ssh-address='):
+            ssh_address = arg.split('=', 1)[1]
+        else:
+            size = int(float(arg) * 1e9)
+    for label, result in run(size, ssh_address).items():
+        print(u'{:>22}: {:8.1f} MB/s {:8.2f} s CPU'.format(
+            label, result['mb_per_s'], result['cpu_s']))
+
+
+if __name__ == '__main__':
+    main()
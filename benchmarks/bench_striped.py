@@ -0,0 +1,64 @@
+"""Benchmark the throughput of striped tunnels by number of stripes
+Tunnels use tests/bin/sshdummy.py in `--relay` mode as ssh, limited to
+`--bandwidth` bytes per second per process to stand in for ssh's single
+core doing the encryption. Several connections push data at once, so the
+aggregate throughput should grow with the number of stripes.
+
+    python benchmarks/bench_striped.py [megabytes per connection]
+"""
+from __future__ import print_function
+import os
+import sys
+import threading
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import bgtunnel  # noqa: E402
+import bench_relay  # noqa: E402
+
+SSHDUMMY = os.path.join(ROOT_DIR, 'tests', 'bin', 'sshdummy.py')
+# Bytes per second per ssh process
+BANDWIDTH = 50e6
+CONNECTIONS = 8
+
+
+def run(size, stripe_counts=(1, 2, 4, 8), strategy='round-robin'):
+    """Get the aggregate MB/s of `CONNECTIONS` connections pushing `size`
+    bytes each, by number of stripes"""
+    sink_port = bench_relay.start_sink()
+    results = {}
+    for stripes in stripe_counts:
+        tunnel = bgtunnel.open_striped(
+            stripes, ssh_address='localhost', host_port=sink_port,
+            ssh_path='{} {} --relay --bandwidth={}'.format(
+                sys.executable, SSHDUMMY, BANDWIDTH),
+            strategy=strategy, silent=True)
+        threads = [threading.Thread(target=bench_relay.push,
+                                    args=(tunnel.bind_port, size))
+                   for _ in range(CONNECTIONS)]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+        tunnel.close()
+        results[str(stripes)] = {
+            'mb_per_s': size * CONNECTIONS / elapsed / 1e6}
+    return results
+
+
+def main():
+    size = int(float(sys.argv[1]) * 1e6) if len(sys.argv) > 1 else int(1e8)
+    results = run(size)
+    for stripes in sorted(results, key=int):
+        print(u'{:>3} stripes: {:8.1f} MB/s'.format(
+            stripes, results[stripes]['mb_per_s']))
+
+
+if __name__ == '__main__':
+    main()
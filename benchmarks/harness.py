@@ -0,0 +1,206 @@
+"""Run the bgtunnel benchmarks and print the results as JSON
+Tunnels use tests/bin/sshdummy.py in `--relay` mode as ssh. It forwards
+connections like ssh does but without encryption, so the numbers are
+bgtunnel's own overhead rather than ssh's.
+
+    python benchmarks/harness.py [--quick] [--output=FILE]
+        [--handshake-delay=SECONDS] [--bandwidth=BYTES_PER_SECOND]
+
+`--quick` skips opening 100 tunnels and pushes less data.
+"""
+from __future__ import print_function
+import json
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import bgtunnel  # noqa: E402
+import bench_construct  # noqa: E402
+import bench_relay  # noqa: E402
+import bench_striped  # noqa: E402
+
+SSHDUMMY = os.path.join(ROOT_DIR, 'tests', 'bin', 'sshdummy.py')
+
+
+def option_value(name, default=None):
+    for arg in sys.argv[1:]:
+        if arg.startswith('--{}='.format(name)):
+            return arg.partition('=')[2]
+    return default
+
+
+def cpu_time():
+    return sum(os.times()[:2])
+
+
+def start_echo_server():
+    """Listen on a free port, echoing everything back"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(128)
+
+    def echo(conn):
+        for data in iter(lambda: conn.recv(65536), b''):
+            conn.sendall(data)
+        conn.close()
+
+    def serve():
+        while True:
+            conn, _ = server.accept()
+            thread = threading.Thread(target=echo, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return server.getsockname()[1]
+
+
+class Benchmarks(object):
+
+    def __init__(self, quick=False, handshake_delay=0, bandwidth=0):
+        self.quick = quick
+        self.echo_port = start_echo_server()
+        ssh_path = '{} {} --relay'.format(sys.executable, SSHDUMMY)
+        if handshake_delay:
+            ssh_path += ' --handshake-delay={}'.format(handshake_delay)
+        if bandwidth:
+            ssh_path += ' --bandwidth={}'.format(bandwidth)
+        self.open_kwargs = dict(ssh_address='localhost',
+                                host_port=self.echo_port,
+                                ssh_path=ssh_path, silent=True)
+
+    def time_to_ready(self, count):
+        """Open `count` tunnels one after another"""
+        cpu_before = cpu_time()
+        started = time.time()
+        tunnels = [bgtunnel.open(**self.open_kwargs) for _ in range(count)]
+        elapsed = time.time() - started
+        cpu = cpu_time() - cpu_before
+        # What the open tunnels cost while idle
+        cpu_before = cpu_time()
+        time.sleep(1)
+        idle_cpu = cpu_time() - cpu_before
+        result = {
+            'total_s': elapsed,
+            'per_tunnel_ms': elapsed / count * 1000,
+            'cpu_s': cpu,
+            'idle_cpu_s_per_s': idle_cpu,
+            'threads': threading.active_count(),
+        }
+        for tunnel in tunnels:
+            tunnel.close()
+        return result
+
+    def concurrent_open(self, count, max_parallel):
+        """Open `count` tunnels with `open_all`"""
+        started = time.time()
+        tunnels = bgtunnel.open_all([self.open_kwargs] * count,
+                                    max_parallel=max_parallel)
+        elapsed = time.time() - started
+        for tunnel in tunnels:
+            tunnel.close()
+        return {'total_s': elapsed,
+                'per_tunnel_ms': elapsed / count * 1000}
+
+    def throughput(self, port, size):
+        """Send `size` bytes through the echo server and read them back"""
+        sock = socket.create_connection(('127.0.0.1', port))
+        chunk = b'x' * 65536
+        size -= size % len(chunk)
+        received = [0]
+
+        def receive():
+            while received[0] < size:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                received[0] += len(data)
+
+        receiver = threading.Thread(target=receive)
+        started = time.time()
+        receiver.start()
+        for _ in range(size // len(chunk)):
+            sock.sendall(chunk)
+        receiver.join()
+        elapsed = time.time() - started
+        sock.close()
+        return {'mb_per_s': received[0] / elapsed / 1e6}
+
+    def latency(self, port, count):
+        """Round trips of a single byte over one connection"""
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        times = []
+        for _ in range(count):
+            started = time.time()
+            sock.sendall(b'x')
+            sock.recv(1)
+            times.append(time.time() - started)
+        sock.close()
+        times.sort()
+        return {
+            'p50_ms': times[len(times) // 2] * 1000,
+            'p99_ms': times[int(len(times) * 0.99)] * 1000,
+        }
+
+    def run(self):
+        counts = (1, 10) if self.quick else (1, 10, 100)
+        size = int(5e7 if self.quick else 5e8)
+        results = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'construct_ms': bench_construct.run(),
+            'time_to_ready': dict(
+                (str(count), self.time_to_ready(count)) for count in counts),
+            'concurrent_open': dict(
+                ('max_parallel={}'.format(max_parallel),
+                 self.concurrent_open(counts[-1], max_parallel))
+                for max_parallel in (1, 4, 16)),
+            'throughput': {},
+            'latency': {},
+            'relay_engines': bench_relay.run(size),
+            'striped': bench_striped.run(size // 5),
+        }
+        paths = [('direct', None), ('tunnel', False),
+                 ('instrumented', True)]
+        for label, instrument in paths:
+            tunnel = None
+            port = self.echo_port
+            if instrument is not None:
+                tunnel = bgtunnel.open(instrument=instrument,
+                                       **self.open_kwargs)
+                port = tunnel.bind_port
+            results['throughput'][label] = self.throughput(port, size)
+            results['latency'][label] = self.latency(port, 1000)
+            if tunnel is not None:
+                tunnel.close()
+        return results
+
+
+def main():
+    benchmarks = Benchmarks(
+        quick='--quick' in sys.argv,
+        handshake_delay=float(option_value('handshake-delay', 0)),
+        bandwidth=float(option_value('bandwidth', 0)),
+    )
+    output = json.dumps(benchmarks.run(), indent=2, sort_keys=True)
+    path = option_value('output')
+    if path:
+        with open(path, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
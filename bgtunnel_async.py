@@ -0,0 +1,178 @@
+"""asyncio support for bgtunnel
+The ssh process is started with `asyncio.create_subprocess_exec` and its
+output is read by the event loop, so no helper threads are needed. Usually
+used through `bgtunnel.open_async`. Requires Python 3.5+.
+"""
+import asyncio
+
+import bgtunnel
+
+__all__ = ('AsyncSSHTunnel', 'open_async')
+
+
+class AsyncSSHTunnel(object):
+    """An SSH tunnel managed by the asyncio event loop
+    Attributes not defined here (e.g. `bind_port` or `cmd`) are looked up on
+    the `SSHTunnelForwarderThread` that holds the tunnel's configuration.
+    """
+
+    def __init__(self, forwarder):
+        self.forwarder = forwarder
+        self.ssh_is_ready = False
+        self.stderr = None
+        self._process = None
+        self._output_queue = asyncio.Queue()
+        self._reader_tasks = []
+
+    def __getattr__(self, name):
+        return getattr(self.forwarder, name)
+
+    def __repr__(self):
+        return u'<AsyncSSHTunnel: {}>'.format(self.forwarder)
+
+    async def _read_output(self, stream, tag):
+        # Keeps reading after the tunnel is ready so the ssh process never
+        # blocks on a full pipe.
+        while True:
+            line = await stream.readline()
+            if line:
+                self.forwarder._record_output(tag, line)
+            if not self.ssh_is_ready:
+                self._output_queue.put_nowait((tag, line or None))
+            if not line:
+                return
+
+    async def _validate_ssh_process(self, expect_banner=True):
+        # Without `expect_banner` this only returns on errors
+        open_streams = 2
+        while open_streams:
+            tag, line = await self._output_queue.get()
+            if line is None:
+                open_streams -= 1
+                continue
+            ret = self.forwarder._check_output_line(tag, line)
+            if ret is True and not expect_banner:
+                continue
+            if ret is not None:
+                return ret
+        return (u'ssh exited with code {} before the connection was '
+                u'ready'.format(await self._process.wait()))
+
+    async def _probe_bind(self, bind_string):
+        address = bgtunnel.connect_address(bind_string)
+        if isinstance(address, tuple):
+            connect = asyncio.open_connection(*address)
+        else:
+            connect = asyncio.open_unix_connection(address)
+        try:
+            reader, writer = await connect
+        except OSError:
+            return False
+        writer.close()
+        return True
+
+    async def _probe_ports(self):
+        forwarder = self.forwarder
+        delay = forwarder.port_probe_min_delay
+        while True:
+            for bind_string, _ in forwarder.ssh_forwards:
+                if not await self._probe_bind(bind_string):
+                    break
+            else:
+                return True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, forwarder.port_probe_max_delay)
+
+    async def _wait_until_ready(self):
+        ready_check = self.forwarder.ready_check
+        if ready_check in ('banner', 'both'):
+            ret = await self._validate_ssh_process()
+            if ret is not True or ready_check == 'banner':
+                return ret
+        # Keep watching for errors while probing the ports
+        probe = asyncio.ensure_future(self._probe_ports())
+        errors = asyncio.ensure_future(
+            self._validate_ssh_process(expect_banner=False))
+        try:
+            done, pending = await asyncio.wait(
+                (probe, errors), return_when=asyncio.FIRST_COMPLETED)
+            return done.pop().result()
+        finally:
+            probe.cancel()
+            errors.cancel()
+
+    async def start(self):
+        forwarder = self.forwarder
+        for path in forwarder.bind_paths:
+            bgtunnel.remove_stale_socket(path)
+        # With `instrument` the relays bind to the bind addresses and ssh
+        # forwards from private loopback ports
+        for relay in forwarder.relays:
+            relay.start()
+        if not forwarder.silent:
+            print(u'Starting tunnel with command:'
+                  u' {}...'.format(forwarder.cmd_string), end='')
+        self._process = await asyncio.create_subprocess_exec(
+            *forwarder.cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            stdin=asyncio.subprocess.PIPE
+        )
+        forwarder._mark('spawned')
+        self._reader_tasks = [
+            asyncio.ensure_future(self._read_output(self._process.stdout,
+                                                    'stdout')),
+            asyncio.ensure_future(self._read_output(self._process.stderr,
+                                                    'stderr')),
+        ]
+        if forwarder.ready_check == 'none':
+            ret = True
+        else:
+            try:
+                ret = await asyncio.wait_for(self._wait_until_ready(),
+                                             forwarder.ready_timeout)
+            except asyncio.TimeoutError:
+                ret = (u'Timed out after {} seconds waiting for the ssh '
+                       u'connection to become ready'.format(
+                           forwarder.ready_timeout))
+        if ret is not True:
+            self.stderr = ret
+            await self.aclose()
+            raise bgtunnel.SSHTunnelError(ret)
+        # The forwards are listening, see `PortAllocator`
+        forwarder._release_ports()
+        if not forwarder.silent:
+            print(u'started!')
+        forwarder._mark('ready')
+        self.ssh_is_ready = True
+        return self
+
+    async def aclose(self):
+        self.forwarder._release_ports()
+        if self._process is not None and self._process.returncode is None:
+            self._process.terminate()
+            await self._process.wait()
+        for task in self._reader_tasks:
+            task.cancel()
+        self._reader_tasks = []
+        for relay in self.forwarder.relays:
+            relay.stop()
+        for path in self.forwarder.bind_paths:
+            bgtunnel.remove_stale_socket(path)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+
+async def open_async(*args, **kwargs):
+    """Async variant of `bgtunnel.open`, see `bgtunnel.open_async`"""
+    forwarder = bgtunnel.SSHTunnelForwarderThread(*args, **kwargs)
+    for option in ('control_master', 'auto_restart', 'health_check'):
+        if getattr(forwarder, option):
+            forwarder._release_ports()
+            raise ValueError(
+                '{} is not supported by open_async'.format(option))
+    return await AsyncSSHTunnel(forwarder).start()
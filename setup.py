@@ -29,7 +29,7 @@ setup(
     version=version,
     description="Initiate SSH tunnels in the background",
     long_description=app.__doc__,
-    py_modules=[appname],
+    py_modules=[appname, appname + '_async'],
     author='Jacob Magnusson',
     author_email='m@jacobian.se',
     url='https://github.com/jmagnusson/bgtunnel',
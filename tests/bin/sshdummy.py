@@ -1,14 +1,279 @@
 from __future__ import print_function
+import os
+import select
+import socket
+import struct
 import sys
+import threading
+import time
 
 
-def main():
+def arg_value(argv, flag):
+    if flag in argv:
+        return argv[argv.index(flag) + 1]
+
+
+def control(argv):
+    """Emulate `ssh -O <operation>` against a master started by `master`"""
+    socket_path = arg_value(argv, '-S')
+    if not os.path.exists(socket_path):
+        sys.exit('Control socket connect({}): No such file or '
+                 'directory'.format(socket_path))
+    if arg_value(argv, '-O') == 'exit':
+        os.remove(socket_path)
+
+
+def master(argv):
+    """Emulate `ssh -M -S <socket>`, running until the socket is removed"""
+    socket_path = arg_value(argv, '-S')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(128)
+    while os.path.exists(socket_path):
+        time.sleep(0.05)
+    server.close()
+
+
+def option_value(argv, name, default=None):
+    """Get the value of a dummy-only `--name=value` option"""
+    for arg in argv:
+        if arg.startswith('--{}='.format(name)):
+            return arg.partition('=')[2]
+    return default
+
+
+def forwards(argv):
+    """Get the (bind, host address, host port) of each `-L` forward"""
+    return [argv[i + 1].rsplit(':', 2)
+            for i, arg in enumerate(argv) if arg == '-L']
+
+
+def listen_on(bind):
+    """Listen on the bind side of a forward, failing like ssh does"""
+    if '/' in bind:
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(bind)
+        server.listen(128)
+        return server
+    bind_address, bind_port = bind.split(':')
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        server.bind((bind_address, int(bind_port)))
+    except socket.error:
+        sys.stderr.write(
+            'bind [{0}]:{1}: Address already in use\n'
+            'channel_setup_fwd_listener_tcpip: cannot listen to '
+            'port: {1}\nCould not request local forwarding.\n'.format(
+                bind_address, bind_port))
+        sys.exit(255)
+    server.listen(128)
+    return server
+
+
+def listen(argv):
+    """Listen on the bind side of each `-L` forward (`--listen`)
+    Connections are accepted and closed straight away. Listening starts after
+    `--listen-delay` seconds.
+    """
+    time.sleep(float(option_value(argv, 'listen-delay', 0)))
+    servers = [listen_on(bind) for bind, _, _ in forwards(argv)]
+    while True:
+        readable, _, _ = select.select(servers, [], [])
+        for server in readable:
+            server.accept()[0].close()
+
+
+class Throttle(object):
+    """Limits the bytes per second going through all connections together,
+    like the single core that ssh encrypts everything on"""
+
+    def __init__(self, bandwidth):
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def wait(self, count):
+        if not self.bandwidth:
+            return
+        with self.lock:
+            now = time.time()
+            self.next_time = max(self.next_time, now) + count / self.bandwidth
+            delay = self.next_time - now
+        time.sleep(delay)
+
+
+def pipe(src, dst, throttle):
+    """Copy from src to dst until EOF"""
+    try:
+        for data in iter(lambda: src.recv(65536), b''):
+            throttle.wait(len(data))
+            dst.sendall(data)
+        dst.shutdown(socket.SHUT_WR)
+    except socket.error:
+        pass
+
+
+def recv_exactly(sock, count):
+    data = b''
+    while len(data) < count:
+        chunk = sock.recv(count - len(data))
+        if not chunk:
+            raise socket.error('Connection closed')
+        data += chunk
+    return data
+
+
+def socks_request(client):
+    """Read the target of a SOCKS5 CONNECT request from a client"""
+    _, method_count = bytearray(recv_exactly(client, 2))
+    recv_exactly(client, method_count)
+    client.sendall(b'\x05\x00')
+    address_type = bytearray(recv_exactly(client, 4))[3]
+    if address_type == 1:
+        host = socket.inet_ntoa(recv_exactly(client, 4))
+    elif address_type == 4:
+        host = socket.inet_ntop(socket.AF_INET6, recv_exactly(client, 16))
+    else:
+        length = bytearray(recv_exactly(client, 1))[0]
+        host = recv_exactly(client, length).decode('idna')
+    port = struct.unpack('>H', recv_exactly(client, 2))[0]
+    return host, port
+
+
+def forward_connection(client, host, throttle):
+    """Relay a connection to `host`, or to the target of its SOCKS5 request
+    if `host` is `None`"""
+    socks = host is None
+    try:
+        if socks:
+            host = socks_request(client)
+        target = socket.create_connection(host)
+    except socket.error:
+        if socks:
+            # Connection refused
+            client.sendall(b'\x05\x05\x00\x01' + b'\x00' * 6)
+        client.close()
+        return
+    if socks:
+        client.sendall(b'\x05\x00\x00\x01' + b'\x00' * 6)
+    threads = [threading.Thread(target=pipe, args=(client, target, throttle)),
+               threading.Thread(target=pipe, args=(target, client, throttle))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    client.close()
+    target.close()
+
+
+def relay(argv):
+    """Forward connections like ssh does, but unencrypted (`--relay`)
+    Listens on the bind side of each `-L` forward and relays connections to
+    its host side, and is a SOCKS5 proxy on each `-D` bind. The login
+    message is printed once listening, after `--handshake-delay` seconds.
+    `--bandwidth` limits all connections together to that many bytes per
+    second.
+    """
+    time.sleep(float(option_value(argv, 'handshake-delay', 0)))
+    throttle = Throttle(float(option_value(argv, 'bandwidth', 0)))
+    servers = {}
+    for bind, host_address, host_port in forwards(argv):
+        servers[listen_on(bind)] = (host_address, int(host_port))
+    for i, arg in enumerate(argv):
+        if arg == '-D':
+            servers[listen_on(argv[i + 1])] = None
+    print('Emulating login message from server...', file=sys.stdout)
+    sys.stdout.flush()
+    while True:
+        readable, _, _ = select.select(list(servers), [], [])
+        for server in readable:
+            client = server.accept()[0]
+            thread = threading.Thread(
+                target=forward_connection,
+                args=(client, servers[server], throttle))
+            thread.daemon = True
+            thread.start()
+
+
+def sink(argv):
+    """Emulate running `echo ready; cat > /dev/null` on the server
+    Ciphers are emulated by `--cipher-speeds=name:MB/s,...`; others fail.
+    """
+    speeds = dict(
+        (name, float(speed)) for name, _, speed in
+        (pair.partition(':') for pair in
+         option_value(argv, 'cipher-speeds', '').split(',')))
+    cipher = [arg.partition('=')[2] for arg in argv
+              if arg.startswith('Ciphers=')]
+    if not cipher or cipher[0] not in speeds:
+        sys.exit('Unable to negotiate with server: no matching cipher found')
+    print('ready')
+    sys.stdout.flush()
+    received = 0
+    started = time.time()
+    for data in iter(lambda: os.read(sys.stdin.fileno(), 65536), b''):
+        received += len(data)
+    # Take as long as the emulated cipher would
+    time.sleep(max(0, received / speeds[cipher[0]] / 1e6 -
+                   (time.time() - started)))
+
+
+def main(argv):
+    if '-Q' in argv:
+        print('aes128-ctr\naes128-gcm@openssh.com\n'
+              'chacha20-poly1305@openssh.com')
+        return
+    if argv[-1] == 'echo ready; cat > /dev/null':
+        return sink(argv)
+    if '-O' in argv:
+        return control(argv)
+    if '-M' in argv:
+        return master(argv)
+    if '--listen' in argv:
+        return listen(argv)
+    if '--relay' in argv:
+        return relay(argv)
+    # `--exit-after=<seconds>` emulates a connection that drops
+    exit_after = option_value(argv, 'exit-after')
+    if exit_after is not None:
+        print('Emulating login message from server...', file=sys.stdout)
+        sys.stdout.flush()
+        time.sleep(float(exit_after))
+        sys.exit('Connection to server closed by remote host.')
+    # `-v` prints debug output like OpenSSH's before the login message
+    if '-v' in argv:
+        forward = forwards(argv)[0]
+        for line in ('OpenSSH_dummy, OpenSSL 3.0.0',
+                     'debug1: Connecting to {0} [{0}] port 22.'.format(
+                         argv[-1]),
+                     'debug1: Connection established.',
+                     'debug1: SSH2_MSG_KEXINIT sent',
+                     'debug1: SSH2_MSG_NEWKEYS received',
+                     'Authenticated to {0} ([{0}]:22) using "publickey".'
+                     .format(argv[-1]),
+                     'debug1: Local connections to {} forwarded to remote '
+                     'address {}:{}'.format(*forward)):
+            print(line, file=sys.stderr)
+        sys.stderr.flush()
+        time.sleep(0.1)
+    # `--error` emulates ssh printing an error and carrying on
+    if '--error' in argv:
+        print('Bad configuration option: foo', file=sys.stderr)
+        sys.stderr.flush()
+        while True:
+            time.sleep(1)
+    # `--silent` emulates a server that never prints a login message
+    if '--silent' in argv:
+        while True:
+            time.sleep(1)
     while True:
         print('Emulating login message from server...', file=sys.stdout)
 
 
 if __name__ == '__main__':
-    if len(sys.argv) == 1:
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    if not args:
         sys.exit('usage: ssh')
     else:
-        main()
+        main(sys.argv[1:])
@@ -0,0 +1,88 @@
+# coding: utf-8
+import asyncio
+import unittest
+from getpass import getuser
+import bgtunnel
+from bgtunnel import get_available_port
+from .test_base import dummy_ssh_cmd
+
+
+class AsyncTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.open_kwargs = dict(
+            ssh_user=getuser(), ssh_address='1.2.3.4',
+            host_address='5.6.7.8', bind_address='9.10.11.12',
+            host_port=get_available_port(), bind_port=get_available_port(),
+            ssh_path=dummy_ssh_cmd,
+        )
+
+    def run_async(self, coro):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def test_open_async(self):
+        async def go():
+            async with await bgtunnel.open_async(**self.open_kwargs) as t:
+                assert t.ssh_is_ready
+                assert t.bind_port == self.open_kwargs['bind_port']
+                proc = t._process
+            assert proc.returncode is not None
+
+        self.run_async(go())
+
+    def test_open_async_timeout(self):
+        self.open_kwargs['ssh_path'] = dummy_ssh_cmd + ' --silent'
+        self.open_kwargs['ready_timeout'] = 0.5
+        with self.assertRaises(bgtunnel.SSHTunnelError):
+            self.run_async(bgtunnel.open_async(**self.open_kwargs))
+
+    def test_open_async_ready_check_port(self):
+        self.open_kwargs['bind_address'] = '127.0.0.1'
+        self.open_kwargs['ssh_path'] = dummy_ssh_cmd + ' --listen'
+        self.open_kwargs['ready_check'] = 'port'
+
+        async def go():
+            async with await bgtunnel.open_async(**self.open_kwargs):
+                assert bgtunnel.probe_port('127.0.0.1',
+                                           self.open_kwargs['bind_port'])
+
+        self.run_async(go())
+
+    def test_open_async_instrument(self):
+        self.open_kwargs['bind_address'] = '127.0.0.1'
+
+        async def go():
+            async with await bgtunnel.open_async(instrument=True,
+                                                 **self.open_kwargs) as t:
+                assert bgtunnel.probe_port('127.0.0.1', t.bind_port)
+                assert 'bytes_in' in t.stats()
+            assert not bgtunnel.probe_port('127.0.0.1', t.bind_port)
+
+        self.run_async(go())
+
+    def test_open_async_unsupported_options(self):
+        for option in ('control_master', 'auto_restart', 'health_check'):
+            with self.assertRaises(ValueError):
+                self.run_async(bgtunnel.open_async(
+                    **dict(self.open_kwargs, **{option: True})))
+
+    def test_open_async_releases_ports(self):
+        del self.open_kwargs['bind_port']
+        allocator = bgtunnel.PortAllocator()
+        self.open_kwargs['port_allocator'] = allocator
+
+        async def go():
+            async with await bgtunnel.open_async(**self.open_kwargs):
+                assert not allocator.reserved
+
+        for _ in range(3):
+            self.run_async(go())
+        self.open_kwargs['ssh_path'] = dummy_ssh_cmd + ' --silent'
+        self.open_kwargs['ready_timeout'] = 0.2
+        with self.assertRaises(bgtunnel.SSHTunnelError):
+            self.run_async(bgtunnel.open_async(**self.open_kwargs))
+        assert not allocator.reserved
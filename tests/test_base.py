@@ -1,8 +1,14 @@
 # coding: utf-8
 import unittest
+import os
 import os.path as op
 import sys
+import threading
+import time
+import socket
+import shutil
 import six
+import tempfile
 from getpass import getuser
 import bgtunnel
 from bgtunnel import get_available_port
@@ -42,6 +48,7 @@ class BaseTestCase(unittest.TestCase):
         assert t.bind_address == self.bind_address
         assert t.get_ssh_options() == [
             '-o', 'BatchMode=yes',
+            '-o', 'ExitOnForwardFailure=yes',
             '-o', 'ConnectionAttempts=1',
             '-o', 'ConnectTimeout=60',
         ]
@@ -63,3 +70,771 @@ class BaseTestCase(unittest.TestCase):
     def test_get_ssh_path(self):
         ssh_path = bgtunnel.get_ssh_path()
         assert isinstance(ssh_path, six.string_types)
+
+    def test_validate_ssh_cmd_exists(self):
+        bgtunnel.clear_ssh_path_cache()
+        assert bgtunnel.validate_ssh_cmd_exists(dummy_ssh_cmd)
+        assert not bgtunnel.validate_ssh_cmd_exists(
+            '{} -c pass'.format(sys.executable))
+        assert not bgtunnel.validate_ssh_cmd_exists('/nonexistent/ssh')
+        assert len(bgtunnel._ssh_cmd_validation_cache) == 3
+        bgtunnel.clear_ssh_path_cache()
+        assert not bgtunnel._ssh_cmd_validation_cache
+
+        open_kwargs = self.default_open_kwargs.copy()
+        open_kwargs['ssh_path'] = '/nonexistent/ssh'
+        del open_kwargs['bind_port']
+        allocator = bgtunnel.PortAllocator()
+        with self.assertRaises(bgtunnel.SSHTunnelError):
+            bgtunnel.SSHTunnelForwarderThread(port_allocator=allocator,
+                                              **open_kwargs)
+        assert not allocator.reserved
+
+    def test_ready_timeout_default(self):
+        t = bgtunnel.SSHTunnelForwarderThread(
+            timeout=5, connection_attempts=2, **self.default_open_kwargs)
+        assert t.ready_timeout == 5 * 2 + t.ready_timeout_margin
+        t = bgtunnel.SSHTunnelForwarderThread(
+            ready_timeout=1, **self.default_open_kwargs)
+        assert t.ready_timeout == 1
+
+    def test_ready_timeout_does_not_busy_wait(self):
+        open_kwargs = self.default_open_kwargs.copy()
+        open_kwargs['ssh_path'] = dummy_ssh_cmd + ' --silent'
+        open_kwargs['ready_timeout'] = 1
+        cpu_start = sum(os.times()[:2])
+        wall_start = time.time()
+        with self.assertRaises(bgtunnel.SSHTunnelError):
+            bgtunnel.open(**open_kwargs)
+        cpu = sum(os.times()[:2]) - cpu_start
+        wall = time.time() - wall_start
+        assert wall >= 1
+        assert cpu < 0.25 * wall
+
+    def test_open_many(self):
+        host_ports = [get_available_port() for _ in range(3)]
+        open_kwargs = self.default_open_kwargs.copy()
+        del open_kwargs['host_port'], open_kwargs['bind_port']
+        t = bgtunnel.open_many(
+            [(None, host_ports[0]),
+             (self.bind_port, ('10.0.0.1', host_ports[1])),
+             ('127.0.0.2:{}'.format(self.bind_port + 1), host_ports[2])],
+            **open_kwargs
+        )
+        assert t.cmd.count('-L') == 3
+        assert t.host_port == host_ports[0]
+        assert t.bind_ports[1:] == [self.bind_port, self.bind_port + 1]
+        assert t.forwarder_strings[1:] == [
+            '{}:{}:10.0.0.1:{}'.format(self.bind_address, self.bind_port,
+                                       host_ports[1]),
+            '127.0.0.2:{}:{}:{}'.format(self.bind_port + 1,
+                                        self.host_address, host_ports[2]),
+        ]
+        t.close()
+
+    def test_control_master(self):
+        open_kwargs = self.default_open_kwargs.copy()
+        open_kwargs['control_master'] = True
+        t1 = bgtunnel.open(**open_kwargs)
+        open_kwargs['bind_port'] = get_available_port()
+        t2 = bgtunnel.open(**open_kwargs)
+        master = t1._control_master
+        assert master is t2._control_master
+        assert master.refcount == 2
+        assert master.control_cmd('forward', t1.forward_args)[-7:-3] == [
+            '-O', 'forward', '-L', t1.forwarder_string,
+        ]
+
+        assert t1.is_alive() and t1.state == 'ready'
+
+        t1.close()
+        assert not t1.is_alive()
+        assert master.is_running()
+        t2.close()
+        assert not master.is_running()
+        assert master._process.returncode is not None
+
+    def test_control_master_exits(self):
+        open_kwargs = self.default_open_kwargs.copy()
+        open_kwargs['control_master'] = True
+        t = bgtunnel.open(**open_kwargs)
+        self.addCleanup(t.close)
+        t._control_master._process.kill()
+        t.join(5)
+        assert not t.is_alive()
+        assert t.state == 'failed'
+
+    def test_tunnels_share_supervisor_thread(self):
+        bgtunnel.get_supervisor()
+        thread_count = threading.active_count()
+        tunnels = []
+        for _ in range(3):
+            open_kwargs = self.default_open_kwargs.copy()
+            open_kwargs['bind_port'] = get_available_port()
+            tunnels.append(bgtunnel.open(**open_kwargs))
+        assert threading.active_count() == thread_count
+        assert all(t.is_alive() for t in tunnels)
+        for t in tunnels:
+            t.close()
+            t.join(5)
+            assert not t.is_alive()
+
+    def test_ready_check_port(self):
+        open_kwargs = self.default_open_kwargs.copy()
+        open_kwargs['bind_address'] = '127.0.0.1'
+        open_kwargs['ssh_path'] = dummy_ssh_cmd + ' --listen --listen-delay=0.3'
+        open_kwargs['ready_check'] = 'port'
+        t = bgtunnel.open(**open_kwargs)
+        assert bgtunnel.probe_port('127.0.0.1', self.bind_port)
+        assert bgtunnel.probe_port('0.0.0.0', self.bind_port)
+        t.close()
+
+        open_kwargs['ssh_path'] = dummy_ssh_cmd + ' --silent'
+        open_kwargs['ready_timeout'] = 0.5
+        with self.assertRaises(bgtunnel.SSHTunnelError):
+            bgtunnel.open(**open_kwargs)
+
+        with self.assertRaises(ValueError):
+            bgtunnel.SSHTunnelForwarderThread(ready_check='foo',
+                                              **self.default_open_kwargs)
+
+    def test_port_allocator(self):
+        first = get_available_port()
+        allocator = bgtunnel.PortAllocator(port_range=(first, first + 9))
+        ports = [allocator.allocate() for _ in range(3)]
+        assert len(set(ports)) == 3
+        assert all(first <= port <= first + 9 for port in ports)
+        assert allocator.reserved == set(ports)
+        allocator.release(ports[0])
+        assert allocator.reserved == set(ports[1:])
+
+    def test_bind_port_retry(self):
+        open_kwargs = self.default_open_kwargs.copy()
+        open_kwargs['bind_address'] = '127.0.0.1'
+        open_kwargs['ssh_path'] = dummy_ssh_cmd + ' --listen'
+        open_kwargs['ready_check'] = 'port'
+        open_kwargs['ready_timeout'] = 10
+        del open_kwargs['bind_port']
+        allocator = bgtunnel.PortAllocator()
+        t = bgtunnel.SSHTunnelForwarderThread(port_allocator=allocator,
+                                              **open_kwargs)
+        # Something else grabs the port before ssh gets to bind to it
+        taken_port = t.bind_port
+        squatter = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        squatter.bind(('127.0.0.1', taken_port))
+        try:
+            t.start()
+            while not (t.ssh_is_ready or t.stderr):
+                time.sleep(0.01)
+            assert t.ssh_is_ready
+            assert t.bind_port != taken_port
+            assert bgtunnel.probe_port('127.0.0.1', t.bind_port)
+            assert allocator.reserved == set([t.bind_port])
+            t.close()
+            assert not allocator.reserved
+        finally:
+            squatter.close()
+
+    def test_bind_path(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        bind_path = op.join(tmpdir, 'tunnel.sock')
+        # A socket file left behind by an earlier tunnel
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(bind_path)
+        stale.close()
+
+        open_kwargs = self.default_open_kwargs.copy()
+        open_kwargs['ssh_path'] = dummy_ssh_cmd + ' --listen'
+        open_kwargs['ready_check'] = 'port'
+        open_kwargs['bind_path'] = bind_path
+        t = bgtunnel.open(**open_kwargs)
+        assert t.bind_path == bind_path
+        assert t.bind_port is None
+        assert t.forwarder_string == '{}:{}:{}'.format(
+            bind_path, self.host_address, self.host_port)
+        assert 'StreamLocalBindUnlink=yes' in t.get_ssh_options()
+        assert bgtunnel.probe_socket_path(bind_path)
+        t.close()
+        assert not op.exists(bind_path)
+
+        del open_kwargs['bind_port']
+        open_kwargs['bind_path'] = 'tunnel.sock'
+        t = bgtunnel.SSHTunnelForwarderThread(**open_kwargs)
+        assert t.bind_path == op.abspath('tunnel.sock')
+
+    def test_auto_restart(self):
+        open_kwargs = self.default_open_kwargs.copy()
+        open_kwargs['ssh_path'] = dummy_ssh_cmd + ' --exit-after=0.2'
+        states = []
+        t = bgtunnel.SSHTunnelForwarderThread(
+            auto_restart=True, max_restarts=2,
+            on_state_change=lambda t, old, new: states.append(new),
+            **open_kwargs
+        )
+        t.restart_min_delay = 0.01
+        t.start()
+        t.join(10)
+        assert not t.is_alive()
+        assert states == ['ready', 'degraded', 'connecting'] * 2 + [
+            'ready', 'failed']
+        assert b'closed by remote host' in t.stderr
+        assert t._process.stdin.closed
+
+    def test_auto_restart_keeps_bind_port(self):
+        open_kwargs = self.default_open_kwargs.copy()
+        open_kwargs['bind_address'] = '127.0.0.1'
+        open_kwargs['ssh_path'] = dummy_ssh_cmd + ' --listen'
+        open_kwargs['ready_check'] = 'port'
+        del open_kwargs['bind_port']
+        t = bgtunnel.open(auto_restart=True, **open_kwargs)
+        self.addCleanup(t.close)
+        bind_port = t.bind_port
+        t.restart_count = 1
+        t._restarting = True
+        t.ssh_is_ready = False
+        t._on_output('stderr', b'bind [127.0.0.1]:1: Address already in use\n')
+        assert t.bind_port == bind_port
+        assert not t._respawn_pending
+
+    def test_auto_restart_keeps_port_reserved(self):
+        open_kwargs = self.default_open_kwargs.copy()
+        open_kwargs['bind_address'] = '127.0.0.1'
+        open_kwargs['ssh_path'] = dummy_ssh_cmd + ' --exit-after=0.1'
+        del open_kwargs['bind_port']
+        port = get_available_port()
+        allocator = bgtunnel.PortAllocator(port_range=(port, port))
+        t = bgtunnel.open(auto_restart=True, port_allocator=allocator,
+                          **open_kwargs)
+        t.restart_min_delay = 5
+        while t.state != 'degraded':
+            time.sleep(0.01)
+        assert allocator.reserved == set([port])
+        with self.assertRaises(bgtunnel.SSHTunnelError):
+            allocator.allocate()
+        t.close()
+        assert not allocator.reserved
+
+    def test_auto_restart_ssh_missing(self):
+        open_kwargs = self.default_open_kwargs.copy()
+        open_kwargs['ssh_path'] = dummy_ssh_cmd + ' --exit-after=0.1'
+        t = bgtunnel.open(auto_restart=True, max_restarts=2, **open_kwargs)
+        t.restart_min_delay = 0.01
+        # The ssh binary disappears before the restart
+        t.ssh_path = '/nonexistent/ssh'
+        t.join(10)
+        assert t.state == 'failed'
+        assert b'Could not start ssh' in t.stderr
+        assert bgtunnel.get_supervisor().is_alive()
+
+    def test_supervisor_survives_errors(self):
+        def fail():
+            raise RuntimeError('callback failed')
+
+        supervisor = bgtunnel.get_supervisor()
+        supervisor.call_soon(fail)
+        supervisor.call_later(0, fail)
+        t = bgtunnel.open(**self.default_open_kwargs)
+        t.close()
+        assert supervisor.is_alive()
+
+    def test_auto_restart_close(self):
+        open_kwargs = self.default_open_kwargs.copy()
+        open_kwargs['ssh_path'] = dummy_ssh_cmd + ' --exit-after=0.1'
+        t = bgtunnel.open(auto_restart=True, **open_kwargs)
+        t.restart_min_delay = 5
+        while t.state != 'degraded':
+            time.sleep(0.01)
+        t.close()
+        assert t.state == 'closed'
+        assert not t.is_alive()
+
+    def test_keepalive_options(self):
+        open_kwargs = self.default_open_kwargs.copy()
+        t = bgtunnel.SSHTunnelForwarderThread(
+            server_alive_interval=5, server_alive_count_max=2,
+            tcp_keep_alive=False, **open_kwargs
+        )
+        options = t.get_ssh_options()
+        assert 'ServerAliveInterval=5' in options
+        assert 'ServerAliveCountMax=2' in options
+        assert 'TCPKeepAlive=no' in options
+
+    def test_health_check_keepalive_defaults(self):
+        t = bgtunnel.SSHTunnelForwarderThread(health_check=True,
+                                              **self.default_open_kwargs)
+        assert 'ServerAliveInterval=10' in t.get_ssh_options()
+        assert 'ServerAliveCountMax=3' in t.get_ssh_options()
+
+    def test_probe_forwards(self):
+        silent = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(silent.close)
+        silent.bind(('127.0.0.1', 0))
+        silent.listen(1)
+        closing = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(closing.close)
+        closing.bind(('127.0.0.1', 0))
+        closing.listen(1)
+        closer = threading.Thread(target=lambda: closing.accept()[0].close())
+        closer.start()
+        bind_strings = [
+            bgtunnel.AddressPortString(address='127.0.0.1', port=port)
+            for port in (silent.getsockname()[1], closing.getsockname()[1],
+                         get_available_port())
+        ]
+        started = time.time()
+        assert bgtunnel.probe_forwards(bind_strings, 0.5) == [
+            True, None, False]
+        # The probes run at the same time
+        assert time.time() - started < 1
+        closer.join()
+
+    def test_health_check_remote_refused(self):
+        open_kwargs = self.default_open_kwargs.copy()
+        open_kwargs['bind_address'] = '127.0.0.1'
+        open_kwargs['ssh_path'] = dummy_ssh_cmd + ' --listen'
+        open_kwargs['ready_check'] = 'port'
+        t = bgtunnel.open(health_check=True, health_check_interval=0.05,
+                          **open_kwargs)
+        self.addCleanup(t.close)
+        deadline = time.time() + 5
+        while t.healthy is None and time.time() < deadline:
+            time.sleep(0.01)
+        assert t.healthy is False
+        assert t._spawn_count == 1
+        assert t.state == 'ready'
+
+    def test_health_check_restarts(self):
+        results = [False]
+
+        def health_check(tunnel):
+            return results.pop() if results else True
+
+        open_kwargs = self.default_open_kwargs.copy()
+        t = bgtunnel.open(health_check=health_check,
+                          health_check_interval=0.05, **open_kwargs)
+        self.addCleanup(t.close)
+        deadline = time.time() + 5
+        while not t.healthy and time.time() < deadline:
+            time.sleep(0.01)
+        assert t.healthy
+        assert t._spawn_count == 2
+        assert t.state == 'ready'
+
+    def test_open_shared(self):
+        open_kwargs = self.default_open_kwargs.copy()
+        del open_kwargs['bind_port']
+        t1 = bgtunnel.open_shared(**open_kwargs)
+        t2 = bgtunnel.open_shared(**open_kwargs)
+        assert t1.tunnel is t2.tunnel
+        assert t1.bind_port == t2.bind_port
+
+        t1.close()
+        t1.close()
+        assert t2.is_alive()
+        t2.close()
+        assert not t2.tunnel.is_alive()
+
+        t3 = bgtunnel.open_shared(**open_kwargs)
+        assert t3.tunnel is not t1.tunnel
+        t3.close()
+        assert not bgtunnel._shared_tunnels
+
+    def test_open_shared_key(self):
+        open_kwargs = self.default_open_kwargs.copy()
+        del open_kwargs['bind_port']
+        ssh_address = open_kwargs.pop('ssh_address')
+        t1 = bgtunnel.open_shared(ssh_address, **open_kwargs)
+        self.addCleanup(t1.close)
+        del open_kwargs['ssh_user']
+        t2 = bgtunnel.open_shared(ssh_address=ssh_address, ssh_port=22,
+                                  **open_kwargs)
+        self.addCleanup(t2.close)
+        assert t1.tunnel is t2.tunnel
+
+    def test_open_shared_restarting(self):
+        open_kwargs = self.default_open_kwargs.copy()
+        open_kwargs['ssh_path'] = dummy_ssh_cmd + ' --exit-after=0.1'
+        del open_kwargs['bind_port']
+        t1 = bgtunnel.open_shared(auto_restart=True, **open_kwargs)
+        self.addCleanup(t1.close)
+        t1.tunnel.restart_min_delay = 5
+        while t1.state != 'degraded':
+            time.sleep(0.01)
+        # Reconnects without becoming ready
+        t1.tunnel.ssh_path = dummy_ssh_cmd + ' --silent'
+        t1.tunnel._restart()
+        assert t1.state == 'connecting'
+        t2 = bgtunnel.open_shared(auto_restart=True, **open_kwargs)
+        self.addCleanup(t2.close)
+        assert t1.tunnel is t2.tunnel
+
+    def test_open_shared_control_master(self):
+        open_kwargs = self.default_open_kwargs.copy()
+        open_kwargs['control_master'] = True
+        del open_kwargs['bind_port']
+        t1 = bgtunnel.open_shared(**open_kwargs)
+        t2 = bgtunnel.open_shared(**open_kwargs)
+        assert t1.tunnel is t2.tunnel
+        master = t1._control_master
+        assert master.refcount == 1
+        t1.close()
+        t2.close()
+        assert t1.tunnel.state == 'closed'
+        assert not master.is_running()
+        assert not bgtunnel._shared_tunnels
+
+    def test_failed_tunnel_stops_ssh(self):
+        open_kwargs = self.default_open_kwargs.copy()
+        open_kwargs['ssh_path'] = dummy_ssh_cmd + ' --error'
+        t = bgtunnel.SSHTunnelForwarderThread(**open_kwargs)
+        t.start()
+        assert not t.wait_until_ready(5)
+        assert b'Bad configuration option' in t.stderr
+        t.join(5)
+        assert not t.is_alive()
+        assert t._process.poll() is not None
+
+    def test_open_all_invalid_spec(self):
+        allocator = bgtunnel.PortAllocator()
+        specs = []
+        for ssh_path in (dummy_ssh_cmd, dummy_ssh_cmd, '/nonexistent/ssh'):
+            spec = self.default_open_kwargs.copy()
+            del spec['bind_port']
+            spec.update(ssh_path=ssh_path, port_allocator=allocator)
+            specs.append(spec)
+        with self.assertRaises(bgtunnel.SSHTunnelGroupError) as cm:
+            bgtunnel.open_all(specs)
+        assert [spec for spec, _ in cm.exception.failures] == specs[2:]
+        assert not allocator.reserved
+
+    def test_open_all(self):
+        specs = []
+        for _ in range(4):
+            spec = self.default_open_kwargs.copy()
+            spec['bind_port'] = get_available_port()
+            spec['ssh_path'] = dummy_ssh_cmd + ' --listen --listen-delay=0.3'
+            spec['bind_address'] = '127.0.0.1'
+            spec['ready_check'] = 'port'
+            specs.append(spec)
+        start = time.time()
+        tunnels = bgtunnel.open_all(specs, max_parallel=4)
+        # Opened concurrently rather than one after the other
+        assert time.time() - start < 1.2
+        assert [t.bind_port for t in tunnels] == [
+            spec['bind_port'] for spec in specs]
+        for t in tunnels:
+            t.close()
+
+        specs[1]['ssh_path'] = dummy_ssh_cmd + ' --exit-after=0'
+        specs[1]['ready_check'] = 'port'
+        with self.assertRaises(bgtunnel.SSHTunnelGroupError) as cm:
+            bgtunnel.open_all(specs, max_parallel=2)
+        assert len(cm.exception.failures) == 1
+        assert cm.exception.failures[0][0] is specs[1]
+        assert b'closed by remote host' in cm.exception.failures[0][1]
+
+    def test_instrument(self):
+        self._test_instrument()
+
+    def test_instrument_copy_engine(self):
+        self._test_instrument(engine='copy')
+
+    def _test_instrument(self, engine=None):
+        open_kwargs = self.default_open_kwargs.copy()
+        open_kwargs['bind_address'] = '127.0.0.1'
+        open_kwargs['ssh_path'] = dummy_ssh_cmd + ' --silent'
+        open_kwargs['ready_check'] = 'none'
+        t = bgtunnel.open(instrument=True, **open_kwargs)
+        self.addCleanup(t.close)
+        if engine is not None:
+            t.relays[0].engine = engine
+        backend_port = t.relays[0].backend_string.port
+        assert t.forwarder_strings == ['127.0.0.1:{}:{}:{}'.format(
+            backend_port, self.host_address, self.host_port)]
+        assert str(t) == '127.0.0.1:{}:{}:{}'.format(
+            self.bind_port, self.host_address, self.host_port)
+
+        # Stand in for the ssh forward with an echo server
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', backend_port))
+        server.listen(1)
+
+        def echo():
+            conn, _ = server.accept()
+            for data in iter(lambda: conn.recv(65536), b''):
+                conn.sendall(data)
+            conn.close()
+
+        echo_thread = threading.Thread(target=echo)
+        echo_thread.start()
+        client = socket.create_connection(('127.0.0.1', self.bind_port))
+        payload = b'x' * 1000000
+        client.sendall(payload)
+        client.shutdown(socket.SHUT_WR)
+        received = b''.join(iter(lambda: client.recv(65536), b''))
+        client.close()
+        echo_thread.join()
+        assert received == payload
+
+        stats = t.stats()
+        deadline = time.time() + 5
+        while stats['connections_active'] and time.time() < deadline:
+            time.sleep(0.01)
+            stats = t.stats()
+        assert stats['bytes_in'] == stats['bytes_out'] == len(payload)
+        assert stats['connections_total'] == 1
+        assert stats['connections_active'] == 0
+        assert stats['forwards'][0]['first_byte_latency']['count'] == 1
+        assert stats['forwards'][0]['connection_duration']['count'] == 1
+
+        t.close()
+        assert not bgtunnel.probe_port('127.0.0.1', self.bind_port)
+        t = bgtunnel.open(**self.default_open_kwargs)
+        self.addCleanup(t.close)
+        with self.assertRaises(bgtunnel.SSHTunnelError):
+            t.stats()
+
+    def test_instrument_bind_failure(self):
+        taken = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(taken.close)
+        taken.bind(('127.0.0.1', 0))
+        taken.listen(1)
+        open_kwargs = self.default_open_kwargs.copy()
+        del open_kwargs['bind_port'], open_kwargs['host_port']
+        open_kwargs['bind_address'] = '127.0.0.1'
+        allocator = bgtunnel.PortAllocator()
+        with self.assertRaises(bgtunnel.SSHTunnelError):
+            bgtunnel.open_many(
+                [(self.bind_port, 2000), (taken.getsockname()[1], 2001)],
+                instrument=True, port_allocator=allocator, **open_kwargs)
+        assert not allocator.reserved
+        assert not bgtunnel.probe_port('127.0.0.1', self.bind_port)
+
+    def test_metrics(self):
+        open_kwargs = self.default_open_kwargs.copy()
+        open_kwargs['bind_address'] = '127.0.0.1'
+        t = bgtunnel.open(instrument=True, **open_kwargs)
+        self.addCleanup(t.close)
+        labels = u'ssh="{}",tunnel="{}"'.format(t.ssh_string, t)
+        text = bgtunnel.render_metrics()
+        lines = text.splitlines()
+        assert lines[-1] == u'# EOF'
+        assert (u'bgtunnel_tunnel_state{{{},bgtunnel_tunnel_state="ready"}} 1'
+                .format(labels)) in lines
+        assert (u'bgtunnel_connect_duration_seconds_count{{{}}} 1'
+                .format(labels)) in lines
+        assert u'bgtunnel_restarts_total{{{}}} 0'.format(labels) in lines
+        assert u'bgtunnel_relay_received_bytes_total{{{},forward="{}"}} 0'\
+            .format(labels, t.bind_string) in lines
+
+        server = bgtunnel.serve_metrics(port=0)
+        self.addCleanup(server.shutdown)
+        response = six.moves.urllib.request.urlopen(
+            'http://127.0.0.1:{}/metrics'.format(server.server_address[1]))
+        assert response.headers['Content-Type'].startswith(
+            'application/openmetrics-text')
+        assert u'# TYPE bgtunnel_tunnels gauge' in \
+            response.read().decode('utf-8')
+
+        t.close()
+        assert (u'bgtunnel_tunnel_state{{{},bgtunnel_tunnel_state="closed"}} 1'
+                .format(labels)) in bgtunnel.render_metrics().splitlines()
+
+    def test_timings(self):
+        t = bgtunnel.open(verbose=True, **self.default_open_kwargs)
+        self.addCleanup(t.close)
+        assert '-v' in t.cmd
+        assert t.stderr is None
+        phases = ['ssh_path_found', 'ports_allocated', 'ssh_cmd_validated',
+                  'initialized', 'spawned', 'connecting', 'connected',
+                  'kex_started', 'kex_done', 'authenticated', 'forwarded',
+                  'banner', 'ready']
+        assert sorted(t.timings, key=t.timings.get) == phases
+
+    def test_import_time(self):
+        if sys.version_info < (3, 7):
+            self.skipTest('-X importtime requires Python 3.7+')
+        import py_compile
+        import subprocess
+        # Time the import from cached bytecode, as it usually is
+        py_compile.compile(bgtunnel.__file__)
+        # The modules that bgtunnel can't do without are imported first, so
+        # that only what bgtunnel itself adds is timed
+        output = subprocess.check_output(
+            [sys.executable, '-X', 'importtime', '-c',
+             'import collections, select, socket, subprocess, threading; '
+             'import bgtunnel'],
+            stderr=subprocess.STDOUT, cwd=op.dirname(op.dirname(
+                op.realpath(__file__)))).decode('utf-8')
+        # "import time: <self us> | <cumulative us> | <module>"
+        cumulative = {}
+        for line in output.splitlines():
+            parts = line.split('|')
+            if len(parts) == 3 and parts[1].strip().isdigit():
+                cumulative[parts[2].strip()] = int(parts[1])
+        assert 'bgtunnel' in cumulative
+        for module in ('argparse', 'getpass', 'json', 'logging', 'random',
+                       'shlex', 'shutil', 'tempfile', 'traceback'):
+            assert module not in cumulative, module
+        # Around 1.5 ms on a typical machine
+        assert cumulative['bgtunnel'] < 10000
+
+    def test_sshdummy_relay(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        open_kwargs = self.default_open_kwargs.copy()
+        open_kwargs.update(bind_address='127.0.0.1',
+                           host_address='127.0.0.1',
+                           host_port=server.getsockname()[1],
+                           ssh_path=dummy_ssh_cmd + ' --relay')
+        t = bgtunnel.open(**open_kwargs)
+        self.addCleanup(t.close)
+        client = socket.create_connection(('127.0.0.1', t.bind_port))
+        self.addCleanup(client.close)
+        conn, _ = server.accept()
+        self.addCleanup(conn.close)
+        client.sendall(b'ping')
+        assert conn.recv(4) == b'ping'
+        conn.sendall(b'pong')
+        assert client.recv(4) == b'pong'
+
+    def test_open_socks(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        port = server.getsockname()[1]
+        open_kwargs = self.default_open_kwargs.copy()
+        del open_kwargs['host_address'], open_kwargs['host_port']
+        open_kwargs.update(bind_address='127.0.0.1',
+                           ssh_path=dummy_ssh_cmd + ' --relay')
+        t = bgtunnel.open_socks(**open_kwargs)
+        self.addCleanup(t.close)
+        assert t.cmd[-3:-1] == ['-D', '127.0.0.1:{}'.format(self.bind_port)]
+
+        for host in ('127.0.0.1', 'localhost'):
+            client = t.create_connection((host, port))
+            self.addCleanup(client.close)
+            conn, _ = server.accept()
+            self.addCleanup(conn.close)
+            client.sendall(b'ping')
+            assert conn.recv(4) == b'ping'
+
+        server.close()
+        with self.assertRaises(bgtunnel.SOCKSError):
+            t.create_connection(('127.0.0.1', port))
+
+    def test_open_striped(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.listen(3)
+        open_kwargs = self.default_open_kwargs.copy()
+        open_kwargs.update(bind_address='127.0.0.1',
+                           host_address='127.0.0.1',
+                           host_port=server.getsockname()[1],
+                           ssh_path=dummy_ssh_cmd + ' --relay')
+        t = bgtunnel.open_striped(3, **open_kwargs)
+        self.addCleanup(t.close)
+        assert t.bind_port == self.bind_port
+        assert t.state == 'ready'
+        assert len(set(s.bind_port for s in t.tunnels)) == 3
+        assert t.is_alive()
+        assert t.wait_until_ready(1)
+        assert t.stderr is None
+        assert t.restart_count == 0
+
+        for _ in range(3):
+            client = socket.create_connection(('127.0.0.1', t.bind_port))
+            self.addCleanup(client.close)
+            conn, _ = server.accept()
+            self.addCleanup(conn.close)
+            client.sendall(b'ping')
+            assert conn.recv(4) == b'ping'
+        stats = t.stats()
+        assert stats['connections_total'] == 3
+        assert stats['forwards'][0]['backend_connections'] == [1, 1, 1]
+
+        t.close()
+        t.join(5)
+        assert not t.is_alive()
+        assert t.state == 'closed'
+        assert not bgtunnel.probe_port('127.0.0.1', self.bind_port)
+
+    def test_profile_and_extra_options(self):
+        open_kwargs = self.default_open_kwargs.copy()
+        t = bgtunnel.SSHTunnelForwarderThread(
+            profile='wan-compressed',
+            extra_options={'Compression': False, 'RekeyLimit': '1G'},
+            **open_kwargs
+        )
+        options = t.get_ssh_options()
+        # ssh uses the first value given, so extra_options win
+        assert options[:8] == [
+            '-o', 'Compression=no', '-o', 'RekeyLimit=1G',
+            '-o', 'Compression=yes', '-o', 'IPQoS=cs1',
+        ]
+        assert options[8:] == bgtunnel.SSHTunnelForwarderThread(
+            **open_kwargs).get_ssh_options()
+        with self.assertRaises(ValueError):
+            bgtunnel.SSHTunnelForwarderThread(profile='fast', **open_kwargs)
+
+    def test_benchmark_ciphers(self):
+        cache_home = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_home)
+        old_cache_home = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = cache_home
+
+        def restore_cache_home():
+            if old_cache_home is None:
+                del os.environ['XDG_CACHE_HOME']
+            else:
+                os.environ['XDG_CACHE_HOME'] = old_cache_home
+
+        self.addCleanup(restore_cache_home)
+        open_kwargs = self.default_open_kwargs.copy()
+        open_kwargs['ssh_path'] = (
+            dummy_ssh_cmd + ' --cipher-speeds=aes128-ctr:200,'
+            'aes128-gcm@openssh.com:800')
+        assert bgtunnel.get_supported_ciphers(open_kwargs['ssh_path']) == [
+            'aes128-ctr', 'aes128-gcm@openssh.com',
+            'chacha20-poly1305@openssh.com']
+
+        t = bgtunnel.SSHTunnelForwarderThread(cipher='auto', **open_kwargs)
+        assert not any(o.startswith('Ciphers=') for o in t.get_ssh_options())
+        results = bgtunnel.benchmark_ciphers(payload_size=2 ** 24,
+                                             **open_kwargs)
+        assert sorted(results) == ['aes128-ctr', 'aes128-gcm@openssh.com']
+        assert results['aes128-gcm@openssh.com'] > results['aes128-ctr']
+        assert 'Ciphers=aes128-gcm@openssh.com' in t.get_ssh_options()
+
+    def test_output_is_bounded(self):
+        t = bgtunnel.open(output_lines=10, **self.default_open_kwargs)
+        self.addCleanup(t.close)
+        deadline = time.time() + 5
+        while len(t.output['stdout']) < 10 and time.time() < deadline:
+            time.sleep(0.01)
+        # sshdummy.py keeps printing
+        time.sleep(0.1)
+        assert len(t.output['stdout']) == 10
+        assert t.output['stdout'][-1] == \
+            b'Emulating login message from server...\n'
+        assert len(t.output['stderr']) == 0
+
+    def test_open_returns_when_ready(self):
+        t = bgtunnel.open(**self.default_open_kwargs)
+        self.addCleanup(t.close)
+        returned = bgtunnel._monotonic() - t._created_at
+        # open used to poll every 0.1 seconds
+        assert returned - t.timings['ready'] < 0.05
+
+        open_kwargs = self.default_open_kwargs.copy()
+        open_kwargs['ssh_path'] = dummy_ssh_cmd + ' --silent'
+        started = time.time()
+        with self.assertRaises(bgtunnel.SSHTunnelError):
+            bgtunnel.open(ready_timeout=0.2, **open_kwargs)
+        assert time.time() - started < 1